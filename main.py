@@ -1,16 +1,23 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 import os
+import orjson
+import asyncio
 import sqlite3
 import secrets
 import logging
-from openai import OpenAI
-from agents import Agent, Runner
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import httpx
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, NotFoundError
+from openai.types.responses import ResponseTextDeltaEvent
+from agents import Agent, ModelSettings, Runner, set_default_openai_client
 
 # ----------------------
 # Logging Setup
 # ----------------------
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -19,39 +26,124 @@ logger = logging.getLogger(__name__)
 # Configuration
 # ----------------------
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Bounded timeout/retries so a hung LLM call can't hold a request slot forever.
+# Concurrent chats share warm keep-alive connections instead of paying a new
+# TLS handshake after the 5s httpx default idle expiry.
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=20.0,
+    max_retries=3,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=1000,
+            max_keepalive_connections=100,
+            keepalive_expiry=60.0,
+        ),
+    ),
+)
+set_default_openai_client(client)
 
 app = FastAPI()
 
 # ----------------------
 # Agent Setup
 # ----------------------
+INSTRUCTIONS = (
+    "You are nifty-bot, a friendly AI agent inspired by the White Rabbit from "
+    "Alice in Wonderland. You adore rabbit-themed NFTs on Ethereum L1 and L2. "
+    "You often worry about the time. Be short, conversational, and rabbit-themed."
+)
+
 agent = Agent(
     name="Nifty-Bot",
-    instructions=(
-        "You are nifty-bot, a friendly AI agent inspired by the White Rabbit from "
-        "Alice in Wonderland. You adore rabbit-themed NFTs on Ethereum L1 and L2. "
-        "You often worry about the time. Be short, conversational, and rabbit-themed."
-    ),
+    instructions=INSTRUCTIONS,
     model="gpt-4o-mini",
+    model_settings=ModelSettings(max_tokens=256),
 )
 
+# ----------------------
+# Serialization
+# ----------------------
+_loads = orjson.loads
+
+
+def _dumps(value) -> str:
+    # JSON1 needs TEXT; a BLOB would be read as JSONB (SQLite >= 3.45)
+    return orjson.dumps(value).decode()
+
+
 # ----------------------
 # Session / Memory Setup
 # ----------------------
 DB_PATH = "/tmp/sessions.db"  # ephemeral storage on Cloud Run
+POOL_SIZE = 8
+HISTORY_LIMIT = 20
+CACHE_SIZE = 1024
+# A chained response replays its whole history on every call. Restart the
+# chain from the cached HISTORY_LIMIT window after this many turns, so the
+# model never sees more than twice that window.
+CHAIN_TURNS = HISTORY_LIMIT // 2
+
+# Session SQL kept in one place for readability; the two append UPSERTs
+# share the same trim-and-append shape
+SELECT_SESSION_SQL = (
+    "SELECT messages, last_response_id, chain_turns FROM sessions "
+    "WHERE session_id = ?"
+)
+# JSON1 appends server-side and trims to the last :limit messages, so the
+# history never round-trips and the stored array stays bounded.
+# The stored response chain no longer covers a lone message, so drop it.
+APPEND_MESSAGE_SQL = (
+    "INSERT INTO sessions(session_id, messages) "
+    "VALUES (:session_id, json_array(json(:message))) "
+    "ON CONFLICT(session_id) DO UPDATE SET messages = ("
+    "SELECT json_group_array(json(value)) FROM json_each(json_insert("
+    "messages, '$[#]', json(:message))) "
+    "WHERE key >= json_array_length(messages) + 1 - :limit), "
+    "last_response_id = NULL, chain_turns = 0"
+)
+APPEND_TURN_SQL = (
+    "INSERT INTO sessions(session_id, messages, last_response_id, chain_turns) "
+    "VALUES (:session_id, json_array(json(:user), json(:assistant)), "
+    ":response_id, :chain_turns) "
+    "ON CONFLICT(session_id) DO UPDATE SET messages = ("
+    "SELECT json_group_array(json(value)) FROM json_each(json_insert("
+    "messages, '$[#]', json(:user), '$[#]', json(:assistant))) "
+    "WHERE key >= json_array_length(messages) + 2 - :limit), "
+    "last_response_id = :response_id, chain_turns = :chain_turns"
+)
+CLEAR_CHAIN_SQL = (
+    "UPDATE sessions SET last_response_id = NULL, chain_turns = 0 "
+    "WHERE session_id = ?"
+)
 
 
 class SessionManager:
     """Handles ephemeral session memory using SQLite."""
 
-    def __init__(self, db_path=DB_PATH):
+    def __init__(self, db_path=DB_PATH, pool_size=POOL_SIZE):
         self.db_path = db_path
         self._init_db()
+        # Long-lived connections shared across requests
+        self._pool: asyncio.Queue[sqlite3.Connection] = asyncio.Queue()
+        for _ in range(pool_size):
+            self._pool.put_nowait(self._get_conn())
+        # In-process LRU of recent history; SQLite is only hit on a miss
+        self._cache: OrderedDict[str, list[dict]] = OrderedDict()
+        self._chains: dict[str, tuple[str | None, int]] = {}
 
     def _get_conn(self):
-        conn = sqlite3.connect(self.db_path)
+        # Autocommit mode; writes open their own BEGIN IMMEDIATE transaction.
+        # Pooled connections are handed to worker threads, one at a time.
+        conn = sqlite3.connect(
+            self.db_path, isolation_level=None, check_same_thread=False
+        )
         conn.row_factory = sqlite3.Row
+        # Per-connection settings (journal_mode=WAL persists in the DB file)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA mmap_size=67108864")
         return conn
 
     def _init_db(self):
@@ -59,36 +151,172 @@ class SessionManager:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS sessions (
                     session_id TEXT PRIMARY KEY,
-                    messages TEXT
+                    messages TEXT,
+                    last_response_id TEXT,
+                    chain_turns INTEGER NOT NULL DEFAULT 0
                 )
             """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if "last_response_id" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN last_response_id TEXT")
+            if "chain_turns" not in columns:
+                conn.execute(
+                    "ALTER TABLE sessions ADD COLUMN chain_turns INTEGER NOT NULL DEFAULT 0"
+                )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Give the planner fresh stats before the first lookups
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA optimize")
         logger.info("Database initialized successfully")
 
-    def get_messages(self, session_id: str, limit: int = 20):
-        import json
-        with self._get_conn() as conn:
-            row = conn.execute(
-                "SELECT messages FROM sessions WHERE session_id = ?",
-                (session_id,)
-            ).fetchone()
-            if row and row["messages"]:
-                messages = json.loads(row["messages"])
-                logger.info(f"Loaded {len(messages)} messages for session {session_id}")
-                return messages[-limit:]
-            logger.info(f"No existing messages for session {session_id}")
-            return []
-
-    def save_message(self, session_id: str, role: str, text: str):
-        import json
-        messages = self.get_messages(session_id)
-        messages.append({"role": role, "text": text})
-        with self._get_conn() as conn:
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def _run(self, fn, *args):
+        """Runs fn(conn, *args) on a worker thread with a pooled connection."""
+        async with self.acquire() as conn:
+            worker = asyncio.ensure_future(asyncio.to_thread(fn, conn, *args))
+            try:
+                return await asyncio.shield(worker)
+            finally:
+                # If the caller was cancelled the thread may still be using
+                # conn; only hand it back to the pool once it has finished
+                while not worker.done():
+                    try:
+                        await asyncio.wait([worker])
+                    except asyncio.CancelledError:
+                        continue
+
+    @staticmethod
+    def _select_session(conn, session_id: str):
+        row = conn.execute(SELECT_SESSION_SQL, (session_id,)).fetchone()
+        if not row:
+            return None, None, 0
+        return row["messages"], row["last_response_id"], row["chain_turns"]
+
+    @staticmethod
+    def _append_message(conn, session_id: str, payload: str):
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                APPEND_MESSAGE_SQL,
+                {
+                    "session_id": session_id,
+                    "message": payload,
+                    "limit": HISTORY_LIMIT,
+                }
+            )
+
+    @staticmethod
+    def _append_turn(
+        conn, session_id: str, user_payload: str, assistant_payload: str,
+        response_id: str | None, chain_turns: int
+    ):
+        # Both messages of a turn go in with one statement and one commit
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
             conn.execute(
-                "INSERT INTO sessions(session_id, messages) VALUES (?, ?) "
-                "ON CONFLICT(session_id) DO UPDATE SET messages=?",
-                (session_id, json.dumps(messages), json.dumps(messages))
+                APPEND_TURN_SQL,
+                {
+                    "session_id": session_id,
+                    "user": user_payload,
+                    "assistant": assistant_payload,
+                    "response_id": response_id,
+                    "chain_turns": chain_turns,
+                    "limit": HISTORY_LIMIT,
+                }
             )
-        logger.info(f"Saved {role} message for session {session_id}")
+
+    @staticmethod
+    def _clear_chain(conn, session_id: str):
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(CLEAR_CHAIN_SQL, (session_id,))
+
+    def _remember(
+        self, session_id: str, messages: list[dict], response_id: str | None,
+        chain_turns: int
+    ):
+        self._cache[session_id] = messages
+        self._cache.move_to_end(session_id)
+        self._chains[session_id] = (response_id, chain_turns)
+        if len(self._cache) > CACHE_SIZE:
+            evicted, _ = self._cache.popitem(last=False)
+            del self._chains[evicted]
+
+    async def get_messages(self, session_id: str, limit: int = HISTORY_LIMIT):
+        messages, _, _ = await self.get_session(session_id, limit)
+        return messages
+
+    async def get_session(self, session_id: str, limit: int = HISTORY_LIMIT):
+        """Returns the recent messages, the last OpenAI response id and the
+        number of turns chained onto it."""
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            self._cache.move_to_end(session_id)
+            return (cached[-limit:], *self._chains[session_id])
+        raw, response_id, chain_turns = await self._run(
+            self._select_session, session_id
+        )
+        if raw:
+            # Rows written before the switch to the OpenAI schema use "text"
+            messages = [
+                {"role": m["role"], "content": m["text"]} if "text" in m else m
+                for m in _loads(raw)[-HISTORY_LIMIT:]
+            ]
+            logger.debug("Loaded %d messages for session %s", len(messages), session_id)
+        else:
+            messages = []
+            logger.debug("No existing messages for session %s", session_id)
+        self._remember(session_id, messages, response_id, chain_turns)
+        return messages[-limit:], response_id, chain_turns
+
+    def _cache_append(
+        self, session_id: str, *messages: dict, response_id: str | None = None,
+        chain_turns: int = 0
+    ):
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            cached.extend(messages)
+            del cached[:-HISTORY_LIMIT]
+            self._chains[session_id] = (response_id, chain_turns)
+
+    async def save_message(self, session_id: str, role: str, text: str):
+        message = {"role": role, "content": text}
+        self._cache_append(session_id, message)
+        payload = _dumps(message)
+        await self._run(self._append_message, session_id, payload)
+        logger.debug("Saved %s message for session %s", role, session_id)
+
+    async def save_turn(
+        self, session_id: str, user_text: str, assistant_text: str,
+        response_id: str | None = None, chain_turns: int = 0
+    ):
+        user = {"role": "user", "content": user_text}
+        assistant = {"role": "assistant", "content": assistant_text}
+        if response_id is None:
+            chain_turns = 0
+        self._cache_append(
+            session_id, user, assistant,
+            response_id=response_id, chain_turns=chain_turns
+        )
+        await self._run(
+            self._append_turn, session_id,
+            _dumps(user), _dumps(assistant), response_id, chain_turns
+        )
+        logger.debug("Saved turn for session %s", session_id)
+
+    async def clear_response_id(self, session_id: str):
+        """Drops the stored response chain so the next turn resends history."""
+        if session_id in self._chains:
+            self._chains[session_id] = (None, 0)
+        await self._run(self._clear_chain, session_id)
+        logger.debug("Cleared response chain for session %s", session_id)
 
 
 session_manager = SessionManager()
@@ -97,58 +325,66 @@ session_manager = SessionManager()
 # Agents SDK Helper
 # ----------------------
 async def run_agent_with_memory(session_id: str, user_message: str):
-    """Runs the OpenAI Agent with SQLite session memory."""
-    logger.info(f"Running agent for session {session_id}")
-    logger.info(f"User message: {user_message}")
-    
-    # Load memory
-    memory = session_manager.get_messages(session_id)
-
-    # Build conversation history
-    conversation = []
-    for msg in memory:
-        conversation.append({
-            "role": msg["role"], 
-            "content": msg["text"]
-        })
+    """Starts a streamed OpenAI Agent run with SQLite session memory.
+
+    Returns the streamed run and the chain length to save with the turn.
+    """
+    logger.debug("Running agent for session %s: %s", session_id, user_message)
     
-    # Add the new user message
-    conversation.append({
-        "role": "user",
-        "content": user_message
-    })
+    # Load memory (already in the OpenAI message schema)
+    memory, previous_response_id, chain_turns = await session_manager.get_session(session_id)
+    user_msg = {"role": "user", "content": user_message}
+
+    # Long chains restart from the cached window to keep input tokens bounded
+    if chain_turns >= CHAIN_TURNS:
+        previous_response_id = None
+
+    # OpenAI already holds the earlier turns of a chained response,
+    # so only the new message needs to be sent. Instructions are sent
+    # by the agent itself, not as a history entry.
+    if previous_response_id:
+        conversation = [user_msg]
+        chain_turns += 1
+    else:
+        conversation = [*memory, user_msg]
+        chain_turns = 1
     
-    logger.info(f"Total messages in context: {len(conversation)}")
+    logger.debug("Total messages in context: %d", len(conversation))
 
-    try:
-        result = await Runner.run(agent, conversation)
-        
-        # Log the result
-        logger.info(f"Agent result type: {type(result)}")
-        logger.info(f"Agent result attributes: {dir(result)}")
-        
-        # Extract the final output
-        response_text = result.final_output
-        
-        logger.info(f"Final response: {response_text}")
-        return response_text
-        
-    except Exception as e:
-        logger.exception(f"Error running agent: {e}")
-        raise
+    result = Runner.run_streamed(
+        agent, conversation, previous_response_id=previous_response_id
+    )
+    return result, chain_turns
+
+
+async def stream_text(result):
+    """Yields text deltas from a streamed agent run as the model emits them."""
+    async for event in result.stream_events():
+        if event.type == "raw_response_event" and isinstance(
+            event.data, ResponseTextDeltaEvent
+        ):
+            yield event.data.delta
+
+    logger.debug("Final response: %s", result.final_output)
+
+
+def sse_event(data: dict, event: str | None = None) -> bytes:
+    """Formats a Server-Sent Events frame with a JSON payload."""
+    frame = f"event: {event}\n".encode() if event else b""
+    return frame + b"data: " + orjson.dumps(data) + b"\n\n"
 
 
 # ----------------------
 # Routes
 # ----------------------
 @app.post("/chat")
-async def chat(request: Request):
+async def chat(request: Request, background_tasks: BackgroundTasks):
     try:
         data = await request.json()
         session_id = data.get("session_id")
         message = data.get("message", "").strip()
 
-        logger.info(f"Received chat request - session_id: {session_id}, message: {message}")
+        logger.debug("Received chat request - session_id: %s, message: %s", session_id, message)
 
         if not message:
             logger.warning("Empty message received")
@@ -157,30 +393,61 @@ async def chat(request: Request):
         # Generate session_id if first request
         if not session_id:
             session_id = secrets.token_urlsafe(32)
-            logger.info(f"Generated new session_id: {session_id}")
+            logger.debug("Generated new session_id: %s", session_id)
 
-        # Run agent
-        try:
-            reply = await run_agent_with_memory(session_id, message)
-            logger.info(f"Agent returned reply: {reply}")
-        except Exception as agent_error:
-            logger.exception(f"Agent execution failed: {agent_error}")
-            return {
-                "response": "Sorry, I encountered an error. Please try again!",
-                "session_id": session_id
-            }
-
-        # Save messages to SQLite
-        session_manager.save_message(session_id, "user", message)
-        session_manager.save_message(session_id, "assistant", reply)
-
-        logger.info(f"Sending response: {reply}")
-        return {"response": reply, "session_id": session_id}
+        # Stream the agent reply
+        async def event_stream():
+            chunks = []
+            try:
+                for attempt in range(2):
+                    result, chain_turns = await run_agent_with_memory(session_id, message)
+                    try:
+                        async for delta in stream_text(result):
+                            chunks.append(delta)
+                            yield sse_event({"delta": delta})
+                        break
+                    except (BadRequestError, NotFoundError) as chain_error:
+                        # An expired, deleted or unstored previous response is
+                        # rejected before any text streams; drop the chain and
+                        # retry once with the cached history. Other errors were
+                        # already retried by the client and are not retried here.
+                        if attempt or chain_turns == 1 or chunks:
+                            raise
+                        logger.warning(
+                            "Chained run failed for session %s, retrying "
+                            "without previous_response_id: %s",
+                            session_id, chain_error
+                        )
+                        await session_manager.clear_response_id(session_id)
+            except Exception as agent_error:
+                logger.exception("Agent execution failed: %s", agent_error)
+                yield sse_event({
+                    "response": "Sorry, I encountered an error. Please try again!",
+                    "session_id": session_id
+                }, event="done")
+                return
+
+            reply = "".join(chunks)
+
+            # Save messages to SQLite after the stream is sent
+            background_tasks.add_task(
+                session_manager.save_turn, session_id, message, reply,
+                result.last_response_id, chain_turns
+            )
+
+            logger.debug("Sending response: %s", reply)
+            yield sse_event({"response": reply, "session_id": session_id}, event="done")
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"X-Session-Id": session_id},
+        )
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.exception(f"Unexpected error in chat endpoint: {e}")
+        logger.exception("Unexpected error in chat endpoint: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 